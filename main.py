@@ -13,7 +13,7 @@ Options:
 
 """
 from lxml import etree
-from datetime import datetime
+from datetime import datetime, timedelta
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from docopt import docopt
@@ -22,18 +22,36 @@ import yaml
 import locale
 import os
 from ftplib import FTP
+from concurrent.futures import ThreadPoolExecutor
 import email.utils
-import platform
 import hashlib
 import pytz
+import re
+import json
+import tempfile
 
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+TOKEN_FILE = os.path.join(SCRIPT_DIR, '.gspread_token.json')
 XML_FILE_DIR = os.path.join(os.environ['HOME'], 'xml-creator-data', 'xml')
+TOKEN_EXPIRY_FORMAT = '%Y-%m-%dT%H:%M:%S'
+TOKEN_EXPIRY_MARGIN = timedelta(minutes=5)
+FTP_WORKERS = 4
+TIMEZONE = pytz.timezone('US/Eastern')
+KEYWORDS_RE = re.compile(r'\s*,\s*')
+RIGHTS_SEP_RE = re.compile(r'[,\n]')
+
+os.makedirs(XML_FILE_DIR, exist_ok=True)
 
 
 def get_temp_xml_file(name):
     """Build temporary file name
 
-    Create directory and construct filename
+    Construct filename inside the XML directory
 
     Args:
         name: String of spreadsheet name
@@ -41,15 +59,15 @@ def get_temp_xml_file(name):
     Returns:
         File name
     """
-    if not os.path.isdir(XML_FILE_DIR):
-        os.makedirs(XML_FILE_DIR)
+    base, ext = os.path.splitext(name)
+    if ext.lower() in ('.mp4', '.mov'):
+        name = base
 
     return os.path.join(XML_FILE_DIR,
-                        "%s.xml" % (name.rstrip('.mp4').rstrip('.mov')
-                                    .replace('@', '_at_')))
+                        "%s.xml" % name.replace('@', '_at_'))
 
 
-def create_xml_file(s_name, wks_name, metadata):
+def create_xml_file(s_name, wks_name, metadata, id_hash='blake2b'):
     """Creates an XML file
 
     Creates an XML file by using video metadata
@@ -58,6 +76,7 @@ def create_xml_file(s_name, wks_name, metadata):
         s_name: String of spreadsheet name
         wks_name: String of worksheet name
         metadata: dictionary of video metadata
+        id_hash: Name of the hash used for the uniqueId, 'blake2b' or 'md5'
 
     Returns:
         File name of created XML file
@@ -70,42 +89,46 @@ def create_xml_file(s_name, wks_name, metadata):
     if os.path.isfile(filename):
         return ''
 
-    xml_file = open(filename, 'w+')
-    create_time = datetime.now(pytz.timezone('US/Eastern')).isoformat()
-    launch_date_time = datetime.now(pytz.timezone('US/Eastern')).isoformat()
-    id = hashlib.md5(metadata['filename'].encode('utf-8')).hexdigest()
-    assets = etree.Element('assets')
-    asset = etree.SubElement(assets, 'asset',
-                             {'language': 'en',
-                              'description': metadata['description'],
-                              'title': metadata['title'],
-                              'baseFileName': metadata['filename'],
-                              'uniqueId': id,
-                              'launchDateTime': launch_date_time,
-                              'createDateTime': create_time,
-                              'status': 'Unencoded',
-                              'action': 'INSERT'})
-    profiles = etree.SubElement(asset, 'profiles')
-    profile = etree.SubElement(profiles, 'profile',
-                               {'launchDateTime': launch_date_time,
-                                'uid': '5afbb2681e654c9eb1ffa17a741b44e8'})
-    files = etree.SubElement(asset, 'files')
-    file = etree.SubElement(files, 'file', {'fileName': metadata['filename'],
-                            'uploaded': 'true'})
-
-    rights = etree.SubElement(asset, 'rights')
-    for right in metadata['rights']:
-        etree.SubElement(rights, 'right', {'name': right})
-
-    keywords_list = metadata['keywords'].split(',')
-    keywords = etree.SubElement(asset, 'keywords')
-    for keyword in keywords_list:
-        etree.SubElement(keywords, 'keyword', {'text': keyword.strip()})
-
-    output = etree.tostring(assets, encoding='utf-8', standalone='yes',
-                            xml_declaration=True, pretty_print=True)
-    xml_file.write(output.decode('utf-8'))
-    xml_file.close()
+    # Created and launched at the same instant
+    create_time = launch_date_time = datetime.now(TIMEZONE).isoformat()
+    if id_hash == 'md5':
+        id = hashlib.md5(metadata['filename'].encode('utf-8')).hexdigest()
+    else:
+        id = hashlib.blake2b(metadata['filename'].encode('utf-8'),
+                             digest_size=16).hexdigest()
+    keywords_list = [keyword for keyword in
+                     KEYWORDS_RE.split(metadata['keywords'].strip())
+                     if keyword]
+
+    # Stream elements straight to disk instead of building a tree
+    with etree.xmlfile(filename, encoding='utf-8') as xf:
+        xf.write_declaration(standalone=True)
+        with xf.element('assets'):
+            with xf.element('asset',
+                            {'language': 'en',
+                             'description': metadata['description'],
+                             'title': metadata['title'],
+                             'baseFileName': metadata['filename'],
+                             'uniqueId': id,
+                             'launchDateTime': launch_date_time,
+                             'createDateTime': create_time,
+                             'status': 'Unencoded',
+                             'action': 'INSERT'}):
+                with xf.element('profiles'):
+                    xf.write(etree.Element(
+                        'profile',
+                        {'launchDateTime': launch_date_time,
+                         'uid': '5afbb2681e654c9eb1ffa17a741b44e8'}))
+                with xf.element('files'):
+                    xf.write(etree.Element(
+                        'file', {'fileName': metadata['filename'],
+                                 'uploaded': 'true'}))
+                with xf.element('rights'):
+                    for right in metadata['rights']:
+                        xf.write(etree.Element('right', name=right))
+                with xf.element('keywords'):
+                    for keyword in keywords_list:
+                        xf.write(etree.Element('keyword', text=keyword))
     return filename
 
 
@@ -113,91 +136,119 @@ def get_rights_from_dict(rights, rights_dict):
     """Return rights from given dictionary
 
     Retrieve the value from a dictionary by matching the key with the
-    comma-delimited string of rights
+    comma or newline delimited string of rights
 
     Args:
-        rights: Comma-delimited string of rights
-        rights_dict: Dictionary or key/value pairs of sports to rights
+        rights: Comma or newline delimited string of rights
+        rights_dict: Set or dictionary of sports to rights
 
     Returns:
-        List of rights
+        List of rights, empty if none match
     """
 
-    if rights.value.find(',') == -1:
-        rights_tmp = list(filter(None, map(str.strip, rights.value.splitlines())))
-    else:
-        rights_tmp = list(filter(None, map(str.strip, rights.value.split(','))))
-
-    if not rights_tmp:
-        return ''
-
-    rights_list = []
-    for x in rights_tmp:
-        if x in rights_dict:
-            rights_list.append(x)
+    tokens = (token.strip() for token in RIGHTS_SEP_RE.split(rights))
+    return [token for token in tokens if token and token in rights_dict]
 
-    return rights_list
 
-
-def get_done_video_metadata(done_cell, cells, header_cells, wks, rights_dict):
+def get_done_video_metadata(row, header_cols, rights_dict):
     """Extracts video metadata
 
-    Gets done row and determine metadata by using column of desired cell
+    Determine metadata of a done row by using the column of each header
 
     Args:
-        done_cell: A gspread cell model
-        cells: A list of cell name strings used to find values
-        header_cells: dictionary of header gspread cell models
-        wks: An instance of a gspread worksheet
-        rights_dict: A dictionary of all of the rights
+        row: A list of cell value strings from the worksheet
+        header_cols: dictionary of header names to column indexes
+        rights_dict: A set of all of the rights
 
     Returns:
         Metadata as a dictionary object
     """
-    # Get cell objects using find method
-    title_cell = header_cells['title']
-    desc_cell = header_cells['description']
-    filename_cell = header_cells['filename']
-    rights_cell = header_cells['rights']
-    rs_cell = header_cells['renderStatus']
-    kws_cell = header_cells['keywords']
-
-    # Get metadata at the same coords that's marked "done"
-    title = wks.cell(done_cell.row, title_cell.col)
-    description = wks.cell(done_cell.row, desc_cell.col)
-    filename = wks.cell(done_cell.row, filename_cell.col)
-    keywords = wks.cell(done_cell.row, kws_cell.col)
-    rights = get_rights_from_dict(wks.cell(done_cell.row, rights_cell.col),
-                                  rights_dict)
-
-    if (done_cell.col == rs_cell.col and title.value != ''
-            and description.value != '' and keywords.value != ''
-            and filename.value != '' and rights != ''):
-        return {'title': title.value, 'description': description.value,
-                'filename': filename.value, 'keywords': keywords.value,
+    title = row[header_cols['title']]
+    description = row[header_cols['description']]
+    filename = row[header_cols['filename']]
+    keywords = row[header_cols['keywords']]
+    rights = get_rights_from_dict(row[header_cols['rights']], rights_dict)
+
+    if (title != '' and description != '' and keywords != ''
+            and filename != '' and rights):
+        return {'title': title, 'description': description,
+                'filename': filename, 'keywords': keywords,
                 'rights': rights}
     return {}
 
 
-def upload_file(file_path, settings):
+def open_ftp(settings):
+    """Open an FTP connection
+
+    Connect, log in and change to the upload directory using the supplied
+    settings
+
+    Args:
+        settings: Dictionary or key/value pair of FTP server settings
+
+    Returns:
+        An instance of a logged in FTP connection or None if settings are
+        missing
+    """
+    if not all(setting in settings
+               for setting in ('host', 'user', 'pass', 'dir')):
+        return None
+
+    ftp = FTP(settings['host'])
+    ftp.login(settings['user'], settings['pass'])
+    ftp.cwd(settings['dir'])
+    return ftp
+
+
+def upload_file(ftp, file_path):
     """Upload a file
 
-    Upload a file using the supplied settings
+    Upload a file over an open FTP connection. The data is sent with
+    socket.sendfile, which copies inside the kernel where supported.
 
     Args:
+        ftp: An instance of a logged in FTP connection
         file_path: String of fullpath to file to upload
+    """
+    filename = os.path.basename(file_path)
+    with open(file_path, 'rb') as file_handle:
+        size = os.fstat(file_handle.fileno()).st_size
+        ftp.voidcmd('TYPE I')
+        conn = ftp.transfercmd('STOR %s' % filename)
+        try:
+            sent = conn.sendfile(file_handle)
+        finally:
+            conn.close()
+        ftp.voidresp()
+
+    if sent < size:
+        raise OSError('Uploaded %d of %d bytes of %s'
+                      % (sent, size, file_path))
+
+
+def upload_files(file_paths, settings):
+    """Upload several files
+
+    Open a connection with the supplied settings and upload each file over it
+
+    Args:
+        file_paths: List of fullpath strings of files to upload
         settings: Dictionary or key/value pair of FTP server settings
+
+    Returns:
+        True if the files were uploaded, False if settings are missing
     """
-    if all(setting in settings
-           for setting in ('host', 'user', 'pass', 'dir')):
-        filename = os.path.basename(file_path)
-        ftp = FTP(settings['host'])
-        ftp.login(settings['user'], settings['pass'])
-        file_handle = open(file_path, 'rb')
-        ftp.cwd(settings['dir'])
-        ftp.storbinary('STOR %s' % filename, file_handle)
-        file_handle.closed
+    ftp = open_ftp(settings)
+    if ftp is None:
+        return False
+
+    try:
+        for file_path in file_paths:
+            upload_file(ftp, file_path)
         ftp.quit()
+    finally:
+        ftp.close()
+    return True
 
 
 def log(message):
@@ -211,14 +262,13 @@ def log(message):
     Returns:
         A message with current date/time format
     """
-    return "%s - %s" % (datetime.now(pytz.timezone('US/Eastern'))
-                        .isoformat(), message)
+    return "%s - %s" % (datetime.now(TIMEZONE).isoformat(), message)
 
 
 def get_yaml_file(filename):
     """Process YAML file
 
-    Open YAML file and return contents. Assumes file is in current directory.
+    Open YAML file and return contents. Assumes file is in script directory.
 
     Args:
         filename: String of filename
@@ -226,11 +276,86 @@ def get_yaml_file(filename):
     Returns:
         List of items from file
     """
-    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                           filename), 'r') as file_handle:
-        output = yaml.load(file_handle)
-    file_handle.closed
-    return output
+    with open(os.path.join(SCRIPT_DIR, filename), 'rb') as file_handle:
+        return yaml.load(file_handle, Loader=_Loader)
+
+
+def get_scope_list(scope):
+    """Normalise OAuth scopes
+
+    Args:
+        scope: A scope string or list of scope strings
+
+    Returns:
+        Sorted list of scope strings
+    """
+    if isinstance(scope, str):
+        scope = [scope]
+    return sorted(scope)
+
+
+def load_cached_token(credentials, scope):
+    """Load a cached access token
+
+    Reuse an access token saved by a previous run so that authorizing does
+    not need to fetch a new one. The token must belong to the same service
+    account and scopes and stay valid for longer than TOKEN_EXPIRY_MARGIN,
+    since gspread does not refresh it during a run.
+
+    Args:
+        credentials: An instance of service account credentials
+        scope: A scope string or list of scope strings
+
+    Returns:
+        The reused access token or None if no cached token was used
+    """
+    try:
+        with open(TOKEN_FILE, 'r') as file_handle:
+            token = json.load(file_handle)
+        if not isinstance(token, dict):
+            return None
+        access_token = token['access_token']
+        expiry = datetime.strptime(token['expiry'], TOKEN_EXPIRY_FORMAT)
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+    if (token.get('email') == credentials.service_account_email
+            and token.get('scope') == get_scope_list(scope)
+            and expiry - TOKEN_EXPIRY_MARGIN > datetime.utcnow()):
+        credentials.access_token = access_token
+        credentials.token_expiry = expiry
+        return access_token
+    return None
+
+
+def save_cached_token(credentials, scope):
+    """Save the current access token
+
+    Write the access token and its expiry so the next run can reuse it.
+    Failing to write the cache is logged and otherwise ignored.
+
+    Args:
+        credentials: An instance of service account credentials
+        scope: A scope string or list of scope strings
+    """
+    if not credentials.access_token or credentials.token_expiry is None:
+        return
+
+    token = {'email': credentials.service_account_email,
+             'scope': get_scope_list(scope),
+             'access_token': credentials.access_token,
+             'expiry': credentials.token_expiry.strftime(TOKEN_EXPIRY_FORMAT)}
+    tmp_path = None
+    try:
+        # mkstemp creates the file with 0600 permissions
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(TOKEN_FILE))
+        with os.fdopen(fd, 'w') as file_handle:
+            json.dump(token, file_handle)
+        os.replace(tmp_path, TOKEN_FILE)
+    except OSError as e:
+        print(log('Could not cache access token: %s' % e))
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def main():
@@ -247,45 +372,69 @@ def main():
     rightsConfig = get_yaml_file('rights.yml')
 
     # Config variables
-    settings, spreadsheet, worksheet, cells, rights = (config['settings'],
-                                                        config['spreadsheet'],
-                                                        config['worksheet'],
-                                                        config['cells'],
-                                                        rightsConfig['rights'])
+    settings, spreadsheet, worksheet, cells, rights = (
+        config['settings'], config['spreadsheet'], config['worksheet'],
+        config['cells'], set(rightsConfig['rights']))
+    id_hash = str(settings.get('uniqueIdHash', 'blake2b')).strip().lower()
+    if id_hash not in ('blake2b', 'md5'):
+        print(log("Unknown uniqueIdHash %r, use 'blake2b' or 'md5'."
+                  % id_hash))
+        return
 
     # Credentials for Google Sheets
-    keyfile = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                           settings['credentials'])
+    keyfile = os.path.join(SCRIPT_DIR, settings['credentials'])
     credentials = ServiceAccountCredentials.from_json_keyfile_name(
         keyfile, settings['scope'])
+    cached_token = load_cached_token(credentials, settings['scope'])
 
     # Get instance of worksheet
     gc = gspread.authorize(credentials)
+    if credentials.access_token != cached_token:
+        save_cached_token(credentials, settings['scope'])
     wks = gc.open(spreadsheet['name']).worksheet(worksheet['name'])
 
-    # Return videos marked as done in "render-status" field and grab headers
-    done_status_cells = wks.findall(cells['renderStatusValue'])
-
-    header_cells = {'title': wks.find(cells['title']),
-                    'description': wks.find(cells['description']),
-                    'filename': wks.find(cells['filename']),
-                    'keywords': wks.find(cells['keywords']),
-                    'rights': wks.find(cells['rights']),
-                    'renderStatus': wks.find(cells['renderStatus'])}
-    video_metadata = list(filter(None,
-                                 [get_done_video_metadata(x, cells,
-                                                          header_cells, wks,
-                                                          rights)
-                                  for x in done_status_cells]))
+    # Fetch the whole worksheet at once and locate the header columns
+    rows = wks.get_all_values()
+    if not rows:
+        print(log('The worksheet is empty.'))
+        return
+
+    header_cols = {}
+    for name in ('title', 'description', 'filename', 'keywords', 'rights',
+                 'renderStatus'):
+        if cells[name] not in rows[0]:
+            print(log('Header "%s" was not found in the first row.'
+                      % cells[name]))
+            return
+        header_cols[name] = rows[0].index(cells[name])
+    status_col = header_cols['renderStatus']
+
+    # Return videos marked as done in "render-status" field
+    done_rows = (row for row in rows[1:]
+                 if row[status_col] == cells['renderStatusValue'])
+    video_metadata = [metadata for metadata in
+                      (get_done_video_metadata(x, header_cols, rights)
+                       for x in done_rows)
+                      if metadata]
 
     if not video_metadata:
         print(log('No videos are ready. Check back later.'))
         return
 
-    xml_files = list(filter(None,
-                            [create_xml_file(spreadsheet['name'],
-                                             worksheet['name'], vid)
-                             for vid in video_metadata]))
+    # Keep only the first row for each filename
+    seen_filenames = set()
+    unique_metadata = []
+    for vid in video_metadata:
+        if vid['filename'] not in seen_filenames:
+            seen_filenames.add(vid['filename'])
+            unique_metadata.append(vid)
+    video_metadata = unique_metadata
+
+    xml_files = [xml_file for xml_file in
+                 (create_xml_file(spreadsheet['name'], worksheet['name'], vid,
+                                  id_hash)
+                  for vid in video_metadata)
+                 if xml_file]
 
     if not xml_files:
         print(log('No XML files were created.'))
@@ -293,18 +442,20 @@ def main():
 
     server = get_yaml_file(serverFile)
 
-    # Upload XML files
-    for xml_file in xml_files:
-        if xml_file:
-            upload_file(xml_file, server['FTP'])
+    ftp_settings = server['FTP']
+
+    # Upload XML files in parallel, one connection per worker
+    workers = max(1, min(int(ftp_settings.get('workers', FTP_WORKERS)),
+                         len(xml_files)))
+    batches = [xml_files[i::workers] for i in range(workers)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        uploaded = list(executor.map(
+            lambda batch: upload_files(batch, ftp_settings), batches))
+
+    if not all(uploaded):
+        print(log('FTP server settings are incomplete.'))
 
 
 if __name__ == '__main__':
-    if platform.system() == 'Windows':
-        p = Process(target=main, args=())
-        p.start()
-        p.join()
-        p.terminate()
-    else:
-        main()
-        sys.exit(0)
+    main()
+    sys.exit(0)